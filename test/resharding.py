@@ -6,6 +6,7 @@
 
 import base64
 import logging
+import Queue
 import threading
 import struct
 import time
@@ -20,6 +21,55 @@ import tablet
 keyspace_id_type = keyrange_constants.KIT_UINT64
 pack_keyspace_id = struct.Struct('!Q').pack
 
+# maximum number of rows sent in a single multi-row insert statement,
+# keeps the statements well under max_allowed_packet
+insert_batch_size = 500
+
+# expected SrvKeyspace partitions as the tablet types are migrated to the
+# split shards
+srv_keyspace_initial = ('Partitions(master): -80 80-\n'
+                        'Partitions(rdonly): -80 80-\n'
+                        'Partitions(replica): -80 80-\n'
+                        'TabletTypes: master,rdonly,replica')
+srv_keyspace_rdonly_split = ('Partitions(master): -80 80-\n'
+                             'Partitions(rdonly): -80 80-C0 C0-\n'
+                             'Partitions(replica): -80 80-\n'
+                             'TabletTypes: master,rdonly,replica')
+srv_keyspace_replica_split = ('Partitions(master): -80 80-\n'
+                              'Partitions(rdonly): -80 80-C0 C0-\n'
+                              'Partitions(replica): -80 80-C0 C0-\n'
+                              'TabletTypes: master,rdonly,replica')
+srv_keyspace_all_split = ('Partitions(master): -80 80-C0 C0-\n'
+                          'Partitions(rdonly): -80 80-C0 C0-\n'
+                          'Partitions(replica): -80 80-C0 C0-\n'
+                          'TabletTypes: master,rdonly,replica')
+
+# keyspace_id_str returns the keyspace_id as it is written in the EMD
+# comments. The results are cached, keyed by keyspace_id_type as well since
+# resharding_bytes.py changes it.
+_keyspace_id_str_cache = {}
+def keyspace_id_str(keyspace_id):
+  key = (keyspace_id_type, keyspace_id)
+  result = _keyspace_id_str_cache.get(key)
+  if result is None:
+    if keyspace_id_type == keyrange_constants.KIT_BYTES:
+      result = base64.b64encode(pack_keyspace_id(keyspace_id))
+    else:
+      result = "%u" % keyspace_id
+    _keyspace_id_str_cache[key] = result
+  return result
+
+# insert_template returns the statement _insert_value uses for a table,
+# with only the row values left to fill in. The results are cached.
+_insert_template_cache = {}
+def insert_template(table):
+  result = _insert_template_cache.get(table)
+  if result is None:
+    result = ('insert into ' + table + '(id, msg, keyspace_id) '
+              'values(%u, "%s", 0x%x) /* EMD keyspace_id:%s user_id:%u */')
+    _insert_template_cache[table] = result
+  return result
+
 # initial shards
 # range "" - 80
 shard_0_master = tablet.Tablet()
@@ -41,25 +91,26 @@ shard_3_replica = tablet.Tablet()
 shard_3_rdonly = tablet.Tablet()
 
 
+all_tablets = [shard_0_master, shard_0_replica,
+               shard_1_master, shard_1_slave1, shard_1_slave2, shard_1_rdonly,
+               shard_2_master, shard_2_replica1, shard_2_replica2,
+               shard_3_master, shard_3_replica, shard_3_rdonly]
+
+
 def setUpModule():
   try:
     environment.topo_server_setup()
 
-    setup_procs = [
-        shard_0_master.init_mysql(),
-        shard_0_replica.init_mysql(),
-        shard_1_master.init_mysql(),
-        shard_1_slave1.init_mysql(),
-        shard_1_slave2.init_mysql(),
-        shard_1_rdonly.init_mysql(),
-        shard_2_master.init_mysql(),
-        shard_2_replica1.init_mysql(),
-        shard_2_replica2.init_mysql(),
-        shard_3_master.init_mysql(),
-        shard_3_replica.init_mysql(),
-        shard_3_rdonly.init_mysql(),
-        ]
+    # building binaries is not thread-safe, so make sure mysqlctl
+    # is there before starting all the tablets in parallel
+    environment.prog_compile('mysqlctl')
+    setup_procs = utils.run_in_parallel(lambda t: t.init_mysql(), all_tablets)
     utils.wait_procs(setup_procs)
+
+    # mysqld keeps running for the whole test, so the many queries we send
+    # directly to it can reuse their connections
+    for t in all_tablets:
+      t.enable_connection_pool()
   except:
     tearDownModule()
     raise
@@ -69,57 +120,78 @@ def tearDownModule():
   if utils.options.skip_teardown:
     return
 
-  teardown_procs = [
-      shard_0_master.teardown_mysql(),
-      shard_0_replica.teardown_mysql(),
-      shard_1_master.teardown_mysql(),
-      shard_1_slave1.teardown_mysql(),
-      shard_1_slave2.teardown_mysql(),
-      shard_1_rdonly.teardown_mysql(),
-      shard_2_master.teardown_mysql(),
-      shard_2_replica1.teardown_mysql(),
-      shard_2_replica2.teardown_mysql(),
-      shard_3_master.teardown_mysql(),
-      shard_3_replica.teardown_mysql(),
-      shard_3_rdonly.teardown_mysql(),
-      ]
+  # same as in setUpModule: teardown can run in its own process, so
+  # mysqlctl may not have been built yet
+  environment.prog_compile('mysqlctl')
+  for t in all_tablets:
+    t.close_connection_pool()
+  teardown_procs = utils.run_in_parallel(lambda t: t.teardown_mysql(),
+                                         all_tablets)
   utils.wait_procs(teardown_procs, raise_on_error=False)
 
   environment.topo_server_teardown()
   utils.kill_sub_processes()
   utils.remove_tmp_files()
 
-  shard_0_master.remove_tree()
-  shard_0_replica.remove_tree()
-  shard_1_master.remove_tree()
-  shard_1_slave1.remove_tree()
-  shard_1_slave2.remove_tree()
-  shard_1_rdonly.remove_tree()
-  shard_2_master.remove_tree()
-  shard_2_replica1.remove_tree()
-  shard_2_replica2.remove_tree()
-  shard_3_master.remove_tree()
-  shard_3_replica.remove_tree()
-  shard_3_rdonly.remove_tree()
+  utils.run_in_parallel(lambda t: t.remove_tree(), all_tablets)
+
+
+# WriterThread executes the statements queued by InsertThreads on a tablet.
+# Every time it wakes up, it sends all the queued statements (up to
+# max_batch_size) in a single transaction. It only stops when done is set,
+# so it is a daemon thread: a test failing before that doesn't hang
+# the process at exit.
+class WriterThread(threading.Thread):
+
+  def __init__(self, tablet, max_batch_size=100):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.tablet = tablet
+    self.max_batch_size = max_batch_size
+    self.queue = Queue.Queue()
+    self.done = False
+    self.start()
+
+  def write(self, statement):
+    self.queue.put(statement)
+
+  def run(self):
+    try:
+      while not self.done:
+        try:
+          statements = [self.queue.get(timeout=0.2)]
+        except Queue.Empty:
+          continue
+        while len(statements) < self.max_batch_size:
+          try:
+            statements.append(self.queue.get_nowait())
+          except Queue.Empty:
+            break
+        self.tablet.mquery('vt_test_keyspace',
+                           ['begin'] + statements + ['commit'],
+                           write=True, user='vt_app')
+    except Exception as e:
+      logging.error("WriterThread got exception: %s", e)
 
 
 # InsertThread will insert a value into the timestamps table, and then
-# every 1/5s will update its value with the current timestamp
+# every 1/5s will queue an update of its value with the current timestamp
+# on the WriterThread. Like the WriterThread, it is a daemon thread.
 class InsertThread(threading.Thread):
 
-  def __init__(self, tablet, object_name, user_id, keyspace_id):
+  def __init__(self, writer, object_name, user_id, keyspace_id):
     threading.Thread.__init__(self)
-    self.tablet = tablet
+    self.daemon = True
+    self.writer = writer
     self.object_name = object_name
     self.user_id = user_id
     self.keyspace_id = keyspace_id
-    if keyspace_id_type == keyrange_constants.KIT_BYTES:
-      self.str_keyspace_id = base64.b64encode(pack_keyspace_id(keyspace_id))
-    else:
-      self.str_keyspace_id = "%u" % keyspace_id
+    self.str_keyspace_id = keyspace_id_str(keyspace_id)
+    # only the bind variables change from one update to the next
+    self.update_sql = 'update timestamps set time_milli=%%s where name=%%s /* EMD keyspace_id:%s user_id:%u */' % (self.str_keyspace_id, self.user_id)
     self.done = False
 
-    self.tablet.mquery('vt_test_keyspace', [
+    self.writer.tablet.mquery('vt_test_keyspace', [
         'begin',
         'insert into timestamps(name, time_milli, keyspace_id) values("%s", %u, 0x%x) /* EMD keyspace_id:%s user_id:%u */' %
         (self.object_name, long(time.time() * 1000), self.keyspace_id,
@@ -129,44 +201,50 @@ class InsertThread(threading.Thread):
     self.start()
 
   def run(self):
-    try:
-      while not self.done:
-        self.tablet.mquery('vt_test_keyspace', [
-            'begin',
-            'update timestamps set time_milli=%u where name="%s" /* EMD keyspace_id:%s user_id:%u */' % (long(time.time() * 1000), self.object_name, self.str_keyspace_id, self.user_id),
-            'commit'
-            ], write=True, user='vt_app')
-        time.sleep(0.2)
-    except Exception as e:
-      logging.error("InsertThread got exception: %s", e)
+    now = time.time
+    # stop if the writer died, there is no one left to send our updates
+    while not self.done and self.writer.is_alive():
+      self.writer.write((self.update_sql,
+                         (long(now() * 1000), self.object_name)))
+      time.sleep(0.2)
 
 
-# MonitorLagThread will get values from a database, and compare the timestamp
-# to evaluate lag. Since the qps is really low, and we send binlogs as chuncks,
-# the latency is pretty high (a few seconds).
-class MonitorLagThread(threading.Thread):
+# LagStats holds the lag samples taken by MonitorLagThread for one object.
+class LagStats(object):
 
   def __init__(self, tablet, object_name):
-    threading.Thread.__init__(self)
     self.tablet = tablet
     self.object_name = object_name
-    self.done = False
     self.max_lag = 0
     self.lag_sum = 0
     self.sample_count = 0
+
+
+# MonitorLagThread will get values from databases, and compare the timestamp
+# to evaluate lag. Since the qps is really low, and we send binlogs as chuncks,
+# the latency is pretty high (a few seconds). A single thread polls all the
+# objects, once a second.
+class MonitorLagThread(threading.Thread):
+
+  def __init__(self, stats_list):
+    threading.Thread.__init__(self)
+    self.stats_list = stats_list
+    self.done = False
     self.start()
 
   def run(self):
     try:
       while not self.done:
-        result = self.tablet.mquery('vt_test_keyspace', 'select time_milli from timestamps where name="%s"' % self.object_name)
-        if result:
-          lag = long(time.time() * 1000) - long(result[0][0])
-          logging.debug("MonitorLagThread(%s) got %u", self.object_name, lag)
-          self.sample_count += 1
-          self.lag_sum += lag
-          if lag > self.max_lag:
-            self.max_lag = lag
+        for stats in self.stats_list:
+          result = stats.tablet.mquery('vt_test_keyspace', 'select time_milli from timestamps where name="%s"' % stats.object_name)
+          if result:
+            lag = long(time.time() * 1000) - long(result[0][0])
+            logging.debug("MonitorLagThread(%s) got %u", stats.object_name,
+                          lag)
+            stats.sample_count += 1
+            stats.lag_sum += lag
+            if lag > stats.max_lag:
+              stats.max_lag = lag
         time.sleep(1.0)
     except Exception as e:
       logging.error("MonitorLagThread got exception: %s", e)
@@ -196,79 +274,55 @@ keyspace_id ''' + t + ''' not null,
 primary key (name)
 ) Engine=InnoDB'''
 
+    # the change is run as a single script by the mysql client on each
+    # tablet, so all the statements can be applied with one vtctl call
+    # (the view needs to come after the table it selects from)
     utils.run_vtctl(['ApplySchemaKeyspace',
                      '-simple',
-                     '-sql=' + create_table_template % ("resharding1"),
-                     'test_keyspace'],
-                    auto_log=True)
-    utils.run_vtctl(['ApplySchemaKeyspace',
-                     '-simple',
-                     '-sql=' + create_table_template % ("resharding2"),
-                     'test_keyspace'],
-                    auto_log=True)
-    utils.run_vtctl(['ApplySchemaKeyspace',
-                     '-simple',
-                     '-sql=' + create_view_template % ("view1", "resharding1"),
-                     'test_keyspace'],
-                    auto_log=True)
-    utils.run_vtctl(['ApplySchemaKeyspace',
-                     '-simple',
-                     '-sql=' + create_timestamp_tablet,
+                     '-sql=' + ';\n'.join([
+                         create_table_template % ("resharding1"),
+                         create_table_template % ("resharding2"),
+                         create_view_template % ("view1", "resharding1"),
+                         create_timestamp_tablet,
+                         ]),
                      'test_keyspace'],
                     auto_log=True)
 
   # _insert_value inserts a value in the MySQL database along with the comments
   # required for routing.
   def _insert_value(self, tablet, table, id, msg, keyspace_id):
-    if keyspace_id_type == keyrange_constants.KIT_BYTES:
-      k = base64.b64encode(pack_keyspace_id(keyspace_id))
-    else:
-      k = "%u" % keyspace_id
-    tablet.mquery('vt_test_keyspace', [
-        'begin',
-        'insert into %s(id, msg, keyspace_id) values(%u, "%s", 0x%x) /* EMD keyspace_id:%s user_id:%u */' % (table, id, msg, keyspace_id, k, id),
-        'commit'
-        ], write=True)
-
-  def _get_value(self, tablet, table, id):
-    return tablet.mquery('vt_test_keyspace', 'select id, msg, keyspace_id from %s where id=%u' % (table, id))
-
-  def _check_value(self, tablet, table, id, msg, keyspace_id,
-                   should_be_here=True):
-    result = self._get_value(tablet, table, id)
-    if keyspace_id_type == keyrange_constants.KIT_BYTES:
-      fmt = "%s"
-      keyspace_id = pack_keyspace_id(keyspace_id)
-    else:
-      fmt = "%x"
-    if should_be_here:
-      self.assertEqual(result, ((id, msg, keyspace_id),),
-                       ("Bad row in tablet %s for id=%u, keyspace_id=" +
-                        fmt + ", row=%s") % (tablet.tablet_alias, id,
-                                             keyspace_id, str(result)))
-    else:
-      self.assertEqual(len(result), 0,
-                       ("Extra row in tablet %s for id=%u, keyspace_id=" +
-                        fmt + ": %s") % (tablet.tablet_alias, id, keyspace_id,
-                                         str(result)))
-
-  # _is_value_present_and_correct tries to read a value.
-  # if it is there, it will check it is correct and return True if it is.
-  # if not correct, it will self.fail.
-  # if not there, it will return False.
-  def _is_value_present_and_correct(self, tablet, table, id, msg, keyspace_id):
-    result = self._get_value(tablet, table, id)
-    if len(result) == 0:
-      return False
-    if keyspace_id_type == keyrange_constants.KIT_BYTES:
-      fmt = "%s"
-      keyspace_id = pack_keyspace_id(keyspace_id)
-    else:
-      fmt = "%x"
-    self.assertEqual(result, ((id, msg, keyspace_id),),
-                     ("Bad row in tablet %s for id=%u, keyspace_id=" + fmt) % (
-                         tablet.tablet_alias, id, keyspace_id))
-    return True
+    sql = insert_template(table) % (id, msg, keyspace_id,
+                                    keyspace_id_str(keyspace_id), id)
+    tablet.mquery('vt_test_keyspace', ['begin', sql, 'commit'], write=True)
+
+  # _insert_values_batch inserts lists of (id, msg, keyspace_id) rows in the
+  # MySQL database, all in one transaction. Each list is sent as multi-row
+  # inserts of at most insert_batch_size rows. Filtered replication routes
+  # a statement using its last EMD comment, so all the rows in a given list
+  # have to belong to the same destination shard.
+  def _insert_values_batch(self, tablet, table, *row_lists):
+    queries = ['begin']
+    for rows in row_lists:
+      for start in xrange(0, len(rows), insert_batch_size):
+        batch = rows[start:start + insert_batch_size]
+        last_id, _, last_keyspace_id = batch[-1]
+        k = keyspace_id_str(last_keyspace_id)
+        values = ', '.join(['(%u, "%s", 0x%x)' % row for row in batch])
+        queries.append('insert into %s(id, msg, keyspace_id) values%s /* EMD keyspace_id:%s user_id:%u */' % (table, values, k, last_id))
+    queries.append('commit')
+    tablet.mquery('vt_test_keyspace', queries, write=True)
+
+  # _fetch_rows reads the rows with the given ids, and returns them
+  # as a dict of id -> (msg, keyspace_id).
+  def _fetch_rows(self, tablet, table, ids, chunk_size=1000):
+    ids = list(ids)
+    rows = {}
+    for start in xrange(0, len(ids), chunk_size):
+      id_list = ', '.join('%u' % id for id in ids[start:start + chunk_size])
+      result = tablet.mquery('vt_test_keyspace', 'select id, msg, keyspace_id from %s where id in (%s)' % (table, id_list))
+      for row in result:
+        rows[row[0]] = row[1:]
+    return rows
 
   def _insert_startup_values(self):
     self._insert_value(shard_0_master, 'resharding1', 1, 'msg1',
@@ -278,79 +332,110 @@ primary key (name)
     self._insert_value(shard_1_master, 'resharding1', 3, 'msg3',
                        0xD000000000000000)
 
+  # _check_startup_values reads both split values from all the split shard
+  # tablets in parallel, and checks each value is in the right shard only.
   def _check_startup_values(self):
-    # check first value is in the right shard
-    self._check_value(shard_2_master, 'resharding1', 2, 'msg2',
-                      0x9000000000000000)
-    self._check_value(shard_2_replica1, 'resharding1', 2, 'msg2',
-                      0x9000000000000000)
-    self._check_value(shard_2_replica2, 'resharding1', 2, 'msg2',
-                      0x9000000000000000)
-    self._check_value(shard_3_master, 'resharding1', 2, 'msg2',
-                      0x9000000000000000, should_be_here=False)
-    self._check_value(shard_3_replica, 'resharding1', 2, 'msg2',
-                      0x9000000000000000, should_be_here=False)
-    self._check_value(shard_3_rdonly, 'resharding1', 2, 'msg2',
-                      0x9000000000000000, should_be_here=False)
-
-    # check second value is in the right shard too
-    self._check_value(shard_2_master, 'resharding1', 3, 'msg3',
-                      0xD000000000000000, should_be_here=False)
-    self._check_value(shard_2_replica1, 'resharding1', 3, 'msg3',
-                      0xD000000000000000, should_be_here=False)
-    self._check_value(shard_2_replica2, 'resharding1', 3, 'msg3',
-                      0xD000000000000000, should_be_here=False)
-    self._check_value(shard_3_master, 'resharding1', 3, 'msg3',
-                      0xD000000000000000)
-    self._check_value(shard_3_replica, 'resharding1', 3, 'msg3',
-                      0xD000000000000000)
-    self._check_value(shard_3_rdonly, 'resharding1', 3, 'msg3',
-                      0xD000000000000000)
-
+    if keyspace_id_type == keyrange_constants.KIT_BYTES:
+      value2 = ('msg2', pack_keyspace_id(0x9000000000000000))
+      value3 = ('msg3', pack_keyspace_id(0xD000000000000000))
+    else:
+      value2 = ('msg2', 0x9000000000000000)
+      value3 = ('msg3', 0xD000000000000000)
+    expected = [
+        (shard_2_master, {2: value2}),
+        (shard_2_replica1, {2: value2}),
+        (shard_2_replica2, {2: value2}),
+        (shard_3_master, {3: value3}),
+        (shard_3_replica, {3: value3}),
+        (shard_3_rdonly, {3: value3}),
+        ]
+    results = utils.run_in_parallel(
+        lambda t: self._fetch_rows(t, 'resharding1', [2, 3]),
+        [t for t, _ in expected])
+    for (t, rows), result in zip(expected, results):
+      self.assertEqual(result, rows,
+                       "Bad rows in tablet %s: expected %s, got %s" % (
+                           t.tablet_alias, str(rows), str(result)))
+
+  # _insert_lots inserts count rows in each of the two split ranges.
   def _insert_lots(self, count, base=0):
-    for i in xrange(count):
-      self._insert_value(shard_1_master, 'resharding1', 10000 + base + i,
-                         'msg-range1-%u' % i, 0xA000000000000000 + base + i)
-      self._insert_value(shard_1_master, 'resharding1', 20000 + base + i,
-                         'msg-range2-%u' % i, 0xE000000000000000 + base + i)
-
-  # _check_lots returns how many of the values we have, in percents.
-  def _check_lots(self, count, base=0):
-    found = 0
-    for i in xrange(count):
-      if self._is_value_present_and_correct(shard_2_replica2, 'resharding1',
-                                            10000 + base + i, 'msg-range1-%u' %
-                                            i, 0xA000000000000000 + base + i):
-        found += 1
-      if self._is_value_present_and_correct(shard_3_replica, 'resharding1',
-                                            20000 + base + i, 'msg-range2-%u' %
-                                            i, 0xE000000000000000 + base + i):
-        found += 1
-    percent = found * 100 / count / 2
+    range1 = [(10000 + base + i, 'msg-range1-%u' % i,
+               0xA000000000000000 + base + i) for i in xrange(count)]
+    range2 = [(20000 + base + i, 'msg-range2-%u' % i,
+               0xE000000000000000 + base + i) for i in xrange(count)]
+    self._insert_values_batch(shard_1_master, 'resharding1', range1, range2)
+
+  # _check_lots_range checks the rows of one range that are present on
+  # the tablet are correct. pending is the set of row indexes not seen yet,
+  # the ones that made it are removed from it.
+  def _check_lots_range(self, tablet, pending, base, id_base, msg_prefix,
+                        keyspace_id_base):
+    rows = self._fetch_rows(tablet, 'resharding1',
+                            [id_base + base + i for i in pending])
+    # the keyspace_id column holds the packed value for bytes, and the
+    # number itself for uint64
+    if keyspace_id_type == keyrange_constants.KIT_BYTES:
+      fmt = "%s"
+      column_value = pack_keyspace_id
+    else:
+      fmt = "%x"
+      column_value = long
+    for id, row in rows.iteritems():
+      i = id - id_base - base
+      keyspace_id = column_value(keyspace_id_base + base + i)
+      self.assertEqual(row, ('%s-%u' % (msg_prefix, i), keyspace_id),
+                       ("Bad row in tablet %s for id=%u, keyspace_id=" +
+                        fmt) % (tablet.tablet_alias, id, keyspace_id))
+      pending.discard(i)
+
+  # _check_lots checks the pending rows of both ranges, and returns how many
+  # of the values we have, in percents. The destination shards that still
+  # have pending rows are checked in parallel.
+  def _check_lots(self, count, pending_range1, pending_range2, base=0):
+    ranges = [(shard_2_replica2, pending_range1, base, 10000, 'msg-range1',
+               0xA000000000000000),
+              (shard_3_replica, pending_range2, base, 20000, 'msg-range2',
+               0xE000000000000000)]
+    utils.run_in_parallel(lambda args: self._check_lots_range(*args),
+                          [r for r in ranges if r[1]])
+    found = 2 * count - len(pending_range1) - len(pending_range2)
+    percent = found * 100 / (2 * count)
     logging.debug("I have %u%% of the data", percent)
     return percent
 
+  # _check_lots_timeout waits until we have threshold percents of the values.
+  # Replicated rows don't go away, so only the ones not seen yet are polled.
+  # Polls start every 0.1s, and back off up to every second.
   def _check_lots_timeout(self, count, threshold, timeout, base=0):
+    pending_range1 = set(xrange(count))
+    pending_range2 = set(xrange(count))
+    deadline = time.time() + timeout
+    sleep_time = 0.1
     while True:
-      value = self._check_lots(count, base=base)
+      value = self._check_lots(count, pending_range1, pending_range2,
+                               base=base)
       if value >= threshold:
         return
-      if timeout == 0:
+      if time.time() >= deadline:
         self.fail("timeout waiting for %u%% of the data" % threshold)
       logging.debug("sleeping until we get %u%%", threshold)
-      time.sleep(1)
-      timeout -= 1
+      time.sleep(sleep_time)
+      sleep_time = min(sleep_time * 1.5, 1.0)
+
+  # _check_lots_range_not_present makes sure none of the ids between
+  # first_id and last_id are on the tablet.
+  def _check_lots_range_not_present(self, tablet, first_id, last_id):
+    result = tablet.mquery('vt_test_keyspace', 'select id from resharding1 where id between %u and %u' % (first_id, last_id))
+    self.assertEqual(len(result), 0,
+                     "Extra rows in tablet %s for ids %u-%u: %s" % (
+                         tablet.tablet_alias, first_id, last_id, str(result)))
 
   # _check_lots_not_present makes sure no data is in the wrong shard
   def _check_lots_not_present(self, count, base=0):
-    found = 0
-    for i in xrange(count):
-      self._check_value(shard_3_replica, 'resharding1', 10000 + base + i,
-                        'msg-range1-%u' % i, 0xA000000000000000 + base + i,
-                        should_be_here=False)
-      self._check_value(shard_2_replica2, 'resharding1', 20000 + base + i,
-                        'msg-range2-%u' % i, 0xE000000000000000 + base + i,
-                        should_be_here=False)
+    utils.run_in_parallel(
+        lambda args: self._check_lots_range_not_present(*args),
+        [(shard_3_replica, 10000 + base, 10000 + base + count - 1),
+         (shard_2_replica2, 20000 + base, 20000 + base + count - 1)])
 
   def _check_binlog_server_vars(self, tablet, timeout=5.0):
     v = utils.get_vars(tablet.port)
@@ -374,21 +459,27 @@ primary key (name)
     shard_1_slave2.init_tablet('spare', 'test_keyspace', '80-')
     shard_1_rdonly.init_tablet('rdonly', 'test_keyspace', '80-')
 
-    utils.run_vtctl(['RebuildKeyspaceGraph', 'test_keyspace'], auto_log=True)
+    # the keyspace graph is only rebuilt once all the shards are reparented
+    # below: nothing reads the SrvKeyspace before that, and ReparentShard
+    # rebuilds the shard graphs it needs.
 
     # create databases so vttablet can start behaving normally
-    for t in [shard_0_master, shard_0_replica, shard_1_master, shard_1_slave1,
-              shard_1_slave2, shard_1_rdonly]:
-      t.create_db('vt_test_keyspace')
+    initial_tablets = [shard_0_master, shard_0_replica, shard_1_master,
+                       shard_1_slave1, shard_1_slave2, shard_1_rdonly]
+    utils.run_in_parallel(lambda t: t.create_db('vt_test_keyspace'),
+                          initial_tablets)
+    for t in initial_tablets:
       t.start_vttablet(wait_for_state=None)
 
     # wait for the tablets
-    shard_0_master.wait_for_vttablet_state('SERVING')
-    shard_0_replica.wait_for_vttablet_state('SERVING')
-    shard_1_master.wait_for_vttablet_state('SERVING')
-    shard_1_slave1.wait_for_vttablet_state('SERVING')
-    shard_1_slave2.wait_for_vttablet_state('NOT_SERVING') # spare
-    shard_1_rdonly.wait_for_vttablet_state('SERVING')
+    utils.wait_for_vttablet_states([
+        (shard_0_master, 'SERVING'),
+        (shard_0_replica, 'SERVING'),
+        (shard_1_master, 'SERVING'),
+        (shard_1_slave1, 'SERVING'),
+        (shard_1_slave2, 'NOT_SERVING'), # spare
+        (shard_1_rdonly, 'SERVING'),
+        ])
 
     # reparent to make the tablets work
     utils.run_vtctl(['ReparentShard', '-force', 'test_keyspace/-80',
@@ -413,25 +504,25 @@ primary key (name)
     for t in [shard_2_master, shard_2_replica1, shard_2_replica2,
               shard_3_master, shard_3_replica, shard_3_rdonly]:
       t.start_vttablet(wait_for_state=None)
-    shard_2_master.wait_for_vttablet_state('CONNECTING')
-    shard_2_replica1.wait_for_vttablet_state('NOT_SERVING')
-    shard_2_replica2.wait_for_vttablet_state('NOT_SERVING')
-    shard_3_master.wait_for_vttablet_state('CONNECTING')
-    shard_3_replica.wait_for_vttablet_state('NOT_SERVING')
-    shard_3_rdonly.wait_for_vttablet_state('CONNECTING')
+    utils.wait_for_vttablet_states([
+        (shard_2_master, 'CONNECTING'),
+        (shard_2_replica1, 'NOT_SERVING'),
+        (shard_2_replica2, 'NOT_SERVING'),
+        (shard_3_master, 'CONNECTING'),
+        (shard_3_replica, 'NOT_SERVING'),
+        (shard_3_rdonly, 'CONNECTING'),
+        ])
 
     utils.run_vtctl(['ReparentShard', '-force', 'test_keyspace/80-C0',
                      shard_2_master.tablet_alias], auto_log=True)
     utils.run_vtctl(['ReparentShard', '-force', 'test_keyspace/C0-',
                      shard_3_master.tablet_alias], auto_log=True)
 
+    # deferred from the initial tablet creation above
     utils.run_vtctl(['RebuildKeyspaceGraph', 'test_keyspace'],
                     auto_log=True)
     utils.check_srv_keyspace('test_nj', 'test_keyspace',
-                             'Partitions(master): -80 80-\n' +
-                             'Partitions(rdonly): -80 80-\n' +
-                             'Partitions(replica): -80 80-\n' +
-                             'TabletTypes: master,rdonly,replica',
+                             srv_keyspace_initial,
                              keyspace_id_type=keyspace_id_type)
 
     # take the snapshot for the split
@@ -442,13 +533,15 @@ primary key (name)
     # and check all the others while we're at it
     shard_1_slave1.wait_for_binlog_server_state("Enabled")
 
-    # perform the restore.
-    utils.run_vtctl(['ShardMultiRestore', '-strategy=populateBlpCheckpoint',
-                     'test_keyspace/80-C0', shard_1_slave1.tablet_alias],
-                    auto_log=True)
-    utils.run_vtctl(['ShardMultiRestore', '-strategy=populateBlpCheckpoint',
-                     'test_keyspace/C0-', shard_1_slave1.tablet_alias],
-                    auto_log=True)
+    # perform the restore. Each restore only locks its destination shard,
+    # and reads the same snapshot from the source tablet, so both can run
+    # at the same time.
+    utils.run_in_parallel(
+        lambda shard: utils.run_vtctl(['ShardMultiRestore',
+                                       '-strategy=populateBlpCheckpoint',
+                                       shard, shard_1_slave1.tablet_alias],
+                                      auto_log=True),
+        ['test_keyspace/80-C0', 'test_keyspace/C0-'])
 
     # check the startup values are in the right place
     self._check_startup_values()
@@ -457,8 +550,8 @@ primary key (name)
     utils.run_vtctl(['ValidateSchemaKeyspace', 'test_keyspace'], auto_log=True)
 
     # check the binlog players are running
-    shard_2_master.wait_for_binlog_player_count(1)
-    shard_3_master.wait_for_binlog_player_count(1)
+    utils.run_in_parallel(lambda t: t.wait_for_binlog_player_count(1),
+                          [shard_2_master, shard_3_master])
 
     # check that binlog server exported the stats vars
     self._check_binlog_server_vars(shard_1_slave1)
@@ -488,18 +581,20 @@ primary key (name)
 
     # start a thread to insert data into shard_1 in the background
     # with current time, and monitor the delay
-    insert_thread_1 = InsertThread(shard_1_master, "insert_low", 10000,
+    writer_thread = WriterThread(shard_1_master)
+    insert_thread_1 = InsertThread(writer_thread, "insert_low", 10000,
                                    0x9000000000000000)
-    insert_thread_2 = InsertThread(shard_1_master, "insert_high", 10001,
+    insert_thread_2 = InsertThread(writer_thread, "insert_high", 10001,
                                    0xD000000000000000)
-    monitor_thread_1 = MonitorLagThread(shard_2_replica2, "insert_low")
-    monitor_thread_2 = MonitorLagThread(shard_3_replica, "insert_high")
+    lag_stats_1 = LagStats(shard_2_replica2, "insert_low")
+    lag_stats_2 = LagStats(shard_3_replica, "insert_high")
+    monitor_thread = MonitorLagThread([lag_stats_1, lag_stats_2])
 
     # tests a failover switching serving to a different replica
     utils.run_vtctl(['ChangeSlaveType', shard_1_slave2.tablet_alias, 'replica'])
     utils.run_vtctl(['ChangeSlaveType', shard_1_slave1.tablet_alias, 'spare'])
-    shard_1_slave2.wait_for_vttablet_state('SERVING')
-    shard_1_slave1.wait_for_vttablet_state('NOT_SERVING')
+    utils.wait_for_vttablet_states([(shard_1_slave2, 'SERVING'),
+                                    (shard_1_slave1, 'NOT_SERVING')])
 
     # test data goes through again
     logging.debug("Inserting lots of data on source shard")
@@ -515,38 +610,26 @@ primary key (name)
     utils.run_vtctl(['MigrateServedTypes', 'test_keyspace/80-', 'rdonly'],
                     auto_log=True)
     utils.check_srv_keyspace('test_nj', 'test_keyspace',
-                             'Partitions(master): -80 80-\n' +
-                             'Partitions(rdonly): -80 80-C0 C0-\n' +
-                             'Partitions(replica): -80 80-\n' +
-                             'TabletTypes: master,rdonly,replica',
+                             srv_keyspace_rdonly_split,
                              keyspace_id_type=keyspace_id_type)
 
     # then serve replica from the split shards
     utils.run_vtctl(['MigrateServedTypes', 'test_keyspace/80-', 'replica'],
                     auto_log=True)
     utils.check_srv_keyspace('test_nj', 'test_keyspace',
-                             'Partitions(master): -80 80-\n' +
-                             'Partitions(rdonly): -80 80-C0 C0-\n' +
-                             'Partitions(replica): -80 80-C0 C0-\n' +
-                             'TabletTypes: master,rdonly,replica',
+                             srv_keyspace_replica_split,
                              keyspace_id_type=keyspace_id_type)
 
     # move replica back and forth
     utils.run_vtctl(['MigrateServedTypes', '-reverse', 'test_keyspace/80-', 'replica'],
                     auto_log=True)
     utils.check_srv_keyspace('test_nj', 'test_keyspace',
-                             'Partitions(master): -80 80-\n' +
-                             'Partitions(rdonly): -80 80-C0 C0-\n' +
-                             'Partitions(replica): -80 80-\n' +
-                             'TabletTypes: master,rdonly,replica',
+                             srv_keyspace_rdonly_split,
                              keyspace_id_type=keyspace_id_type)
     utils.run_vtctl(['MigrateServedTypes', 'test_keyspace/80-', 'replica'],
                     auto_log=True)
     utils.check_srv_keyspace('test_nj', 'test_keyspace',
-                             'Partitions(master): -80 80-\n' +
-                             'Partitions(rdonly): -80 80-C0 C0-\n' +
-                             'Partitions(replica): -80 80-C0 C0-\n' +
-                             'TabletTypes: master,rdonly,replica',
+                             srv_keyspace_replica_split,
                              keyspace_id_type=keyspace_id_type)
 
     # reparent shard_2 to shard_2_replica1, then insert more data and
@@ -568,36 +651,36 @@ primary key (name)
                     auto_log=True)
 
     # going to migrate the master now, check the delays
-    monitor_thread_1.done = True
-    monitor_thread_2.done = True
+    monitor_thread.done = True
     insert_thread_1.done = True
     insert_thread_2.done = True
+    writer_thread.done = True
     logging.debug("DELAY 1: %s max_lag=%u avg_lag=%u",
-                  monitor_thread_1.object_name,
-                  monitor_thread_1.max_lag,
-                  monitor_thread_1.lag_sum / monitor_thread_1.sample_count)
+                  lag_stats_1.object_name,
+                  lag_stats_1.max_lag,
+                  lag_stats_1.lag_sum / lag_stats_1.sample_count)
     logging.debug("DELAY 2: %s max_lag=%u avg_lag=%u",
-                  monitor_thread_2.object_name,
-                  monitor_thread_2.max_lag,
-                  monitor_thread_2.lag_sum / monitor_thread_2.sample_count)
+                  lag_stats_2.object_name,
+                  lag_stats_2.max_lag,
+                  lag_stats_2.lag_sum / lag_stats_2.sample_count)
 
     # then serve master from the split shards
     utils.run_vtctl(['MigrateServedTypes', 'test_keyspace/80-', 'master'],
                     auto_log=True)
     utils.check_srv_keyspace('test_nj', 'test_keyspace',
-                             'Partitions(master): -80 80-C0 C0-\n' +
-                             'Partitions(rdonly): -80 80-C0 C0-\n' +
-                             'Partitions(replica): -80 80-C0 C0-\n' +
-                             'TabletTypes: master,rdonly,replica',
+                             srv_keyspace_all_split,
                              keyspace_id_type=keyspace_id_type)
 
     # check the binlog players are gone now
-    shard_2_master.wait_for_binlog_player_count(0)
-    shard_3_master.wait_for_binlog_player_count(0)
+    utils.run_in_parallel(lambda t: t.wait_for_binlog_player_count(0),
+                          [shard_2_master, shard_3_master])
 
     # scrap the original tablets in the original shard
-    for t in [shard_1_master, shard_1_slave1, shard_1_slave2, shard_1_rdonly]:
-      utils.run_vtctl(['ScrapTablet', t.tablet_alias], auto_log=True)
+    # (the serving ones take turns on the shard lock to rebuild the graph)
+    utils.run_in_parallel(
+        lambda t: utils.run_vtctl(['ScrapTablet', t.tablet_alias],
+                                  auto_log=True),
+        [shard_1_master, shard_1_slave1, shard_1_slave2, shard_1_rdonly])
     tablet.kill_tablets([shard_1_master, shard_1_slave1, shard_1_slave2,
                          shard_1_rdonly])
 
@@ -3,6 +3,7 @@ import logging
 import os
 import shutil
 import sys
+import threading
 import time
 import warnings
 # Dropping a table inexplicably produces a warning despite
@@ -61,6 +62,10 @@ class Tablet(object):
     self.zk_tablet_path = '/zk/test_%s/vt/tablets/%010d' % (self.cell, self.tablet_uid)
     self.zk_pid = self.zk_tablet_path + '/pid'
 
+    # idle connections reused by mquery, see enable_connection_pool
+    self.connection_pool = None
+    self.connection_pool_lock = threading.Lock()
+
   def mysqlctl(self, cmd, quiet=False, extra_my_cnf=None, with_ports=False):
     env = None
     if extra_my_cnf:
@@ -106,25 +111,77 @@ class Tablet(object):
       **self.mysql_connection_parameters(dbname, user))
     return conn, conn.cursor()
 
-  # Query the MySQL instance directly
-  def mquery(self, dbname, query, write=False, user='vt_dba'):
+  # enable_connection_pool makes mquery reuse its connections, instead of
+  # opening a new one for each call. Connections are not shared between
+  # concurrent calls. It should only be used while mysqld keeps running,
+  # and close_connection_pool has to be called before shutting it down.
+  def enable_connection_pool(self):
+    with self.connection_pool_lock:
+      if self.connection_pool is None:
+        self.connection_pool = {}
+
+  def close_connection_pool(self):
+    with self.connection_pool_lock:
+      pool = self.connection_pool
+      self.connection_pool = None
+    if not pool:
+      return
+    for idle in pool.itervalues():
+      for conn, cursor in idle:
+        conn.close()
+
+  # _get_connection returns an idle connection from the pool if there is one,
+  # or a new connection, and whether it should go back to the pool.
+  def _get_connection(self, dbname, user):
+    with self.connection_pool_lock:
+      pooled = self.connection_pool is not None
+      if pooled:
+        idle = self.connection_pool.get((dbname, user))
+        if idle:
+          conn, cursor = idle.pop()
+          return conn, cursor, pooled
     conn, cursor = self.connect(dbname, user=user)
-    if write:
-      conn.begin()
-    if isinstance(query, basestring):
-      query = [query]
-
-    for q in query:
-      # logging.debug("mysql(%s,%s): %s", self.tablet_uid, dbname, q)
-      cursor.execute(q)
+    return conn, cursor, pooled
+
+  def _release_connection(self, dbname, user, conn, cursor, pooled):
+    if pooled:
+      # end the read transaction, so the next queries see newer data
+      conn.rollback()
+      with self.connection_pool_lock:
+        if self.connection_pool is not None:
+          self.connection_pool.setdefault((dbname, user), []).append(
+              (conn, cursor))
+          return
+    conn.close()
+
+  # Query the MySQL instance directly. A statement is either a string, or a
+  # (sql, bindvars) tuple for which the driver fills in the %s in sql with
+  # the escaped bindvars. query is either a single statement, or a list of
+  # statements.
+  def mquery(self, dbname, query, write=False, user='vt_dba'):
+    conn, cursor, pooled = self._get_connection(dbname, user)
+    try:
+      if write:
+        conn.begin()
+      if isinstance(query, (basestring, tuple)):
+        query = [query]
+
+      for q in query:
+        # logging.debug("mysql(%s,%s): %s", self.tablet_uid, dbname, q)
+        if isinstance(q, tuple):
+          cursor.execute(*q)
+        else:
+          cursor.execute(q)
 
-    if write:
-      conn.commit()
+      if write:
+        conn.commit()
 
-    try:
-      return cursor.fetchall()
-    finally:
+      result = cursor.fetchall()
+    except:
       conn.close()
+      raise
+    self._release_connection(dbname, user, conn, cursor, pooled)
+    return result
 
   # path is either:
   # - keyspace/shard for vttablet and vttablet-streaming
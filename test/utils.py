@@ -10,6 +10,7 @@ import signal
 import socket
 from subprocess import Popen, CalledProcessError, PIPE
 import sys
+import threading
 import time
 import unittest
 import urllib
@@ -221,6 +222,35 @@ def run_procs(cmds, raise_on_error=True):
     procs.append(run_bg(cmd))
   wait_procs(procs, raise_on_error=raise_on_error)
 
+# run_in_parallel calls fn(arg) for each arg in args, each in its own thread,
+# and returns the results in the same order. If any of the calls raised,
+# the first exception is re-raised once all the threads are done.
+def run_in_parallel(fn, args):
+  results = [None] * len(args)
+  errors = []
+
+  def run_one(i, arg):
+    try:
+      results[i] = fn(arg)
+    except:
+      errors.append(sys.exc_info())
+
+  threads = [threading.Thread(target=run_one, args=(i, arg))
+             for i, arg in enumerate(args)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  if errors:
+    raise errors[0][0], errors[0][1], errors[0][2]
+  return results
+
+# wait_for_vttablet_states waits for each (tablet, state) pair, all in
+# parallel, so it takes as long as the slowest tablet.
+def wait_for_vttablet_states(tablet_states):
+  run_in_parallel(lambda ts: ts[0].wait_for_vttablet_state(ts[1]),
+                  tablet_states)
+
 # background zk process
 # (note the zkocc addresses will only work with an extra zkocc process)
 zk_port_base = environment.reserve_ports(3)